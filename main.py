@@ -1,26 +1,76 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 import os
+import asyncio
+import logging
+import time
 from dotenv import load_dotenv
 import google.genai
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
 import json
-from typing import Optional, Literal, List
+import orjson
+from hashlib import blake2b
+from typing import Optional, Literal, List, Union, Annotated
 from datetime import datetime, timezone
 
-from motor.motor_asyncio import AsyncIOMotorClient
+from cachetools import TTLCache
 from bson import ObjectId
+from pymongo import AsyncMongoClient, ReturnDocument
+from pymongo.errors import OperationFailure
 
 load_dotenv(".env")
 
+logger = logging.getLogger(__name__)
+
 MONGODB_URL = os.getenv("MONGODB_URL")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 
 if not MONGODB_URL:
     raise RuntimeError("MONGODB_URL missing in .env")
+if not GEMINI_API_KEY:
+    raise RuntimeError("GEMINI_API_KEY missing in .env")
+
+# one client for the whole app (reuses its HTTP connection pool)
+_gemini_client = google.genai.Client(api_key=GEMINI_API_KEY)
+# cap in-flight Gemini calls so bursts don't run into the tier's rate limit
+_GEMINI_SEM = asyncio.Semaphore(int(os.getenv("GEMINI_MAX_CONCURRENCY", "15")))
+# validated Gemini replies keyed by hash(prompt, innerHTML), so retries skip the LLM call
+_chat_cache: TTLCache = TTLCache(maxsize=1024, ttl=3600)
 
 app = FastAPI()
 
+# reject oversized bodies from Content-Length before they're read/decoded/validated.
+# Caps are the model limits (innerHTML 1M + prompt 50k chars) at 4 UTF-8 bytes per char plus
+# room for JSON framing; the Field(max_length=...) bounds on the models still apply as a backup.
+# A batch gets double that, so it can't carry 20 full-size items -- split large batches.
+# Chunked requests (no Content-Length) aren't checked here and fall through to Pydantic.
+MAX_BODY_BYTES = 4 * (1_000_000 + 50_000) + 64_000
+MAX_BATCH_BODY_BYTES = 2 * MAX_BODY_BYTES
+
+
+class BodySizeLimitMiddleware:
+    """Plain ASGI middleware: only inspects scope headers, never wraps the body stream."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            limit = MAX_BATCH_BODY_BYTES if scope["path"] == "/chat/batch" else MAX_BODY_BYTES
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > limit:
+                        response = JSONResponse({"detail": "payload too large"}, status_code=413)
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+
+# added before CORS so CORS wraps it and 413s still carry CORS headers
+app.add_middleware(BodySizeLimitMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # hackathon/dev
@@ -30,7 +80,16 @@ app.add_middleware(
 )
 
 # ---------------- Mongo ----------------
-mongo_client = AsyncIOMotorClient(MONGODB_URL)
+mongo_client = AsyncMongoClient(
+    MONGODB_URL,
+    minPoolSize=5,
+    maxPoolSize=50,
+    maxIdleTimeMS=30_000,
+    serverSelectionTimeoutMS=5_000,
+    waitQueueTimeoutMS=10_000,
+    retryWrites=True,
+    tz_aware=True,  # datetimes come back UTC-aware, so iso() needs no conversion
+)
 db = mongo_client["website_customizer"]
 layouts_col = db["layouts"]                 # current layout
 versions_col = db["layout_versions"]        # last 4 snapshots
@@ -44,12 +103,28 @@ def to_oid(id_str: str) -> ObjectId:
 
 
 def iso(dt: datetime) -> str:
-    return dt.astimezone(timezone.utc).isoformat()
+    # every datetime here is already UTC (datetime.now(timezone.utc) or a tz_aware read)
+    return dt.isoformat()
+
 
+_json_decoder = json.JSONDecoder()
 
-async def snapshot_previous(layout_oid: ObjectId, innerHTML: str, reason: str):
+
+def parse_json_object(text: str) -> Optional[dict]:
+    """Parse the JSON object in text, ignoring any prose Gemini wraps around it."""
+    start = text.find("{")
+    end = text.rfind("}")
+    if start == -1 or end == -1 or end <= start:
+        return None
+    try:
+        return orjson.loads(text[start:end+1])
+    except orjson.JSONDecodeError:
+        # trailing text containing "}" -- decode exactly one object starting at the first "{"
+        return _json_decoder.raw_decode(text, start)[0]
+
+
+async def snapshot_previous(layout_oid: ObjectId, innerHTML: str, reason: str, now: datetime):
     """Insert a snapshot, then keep only last 4 snapshots for that layout."""
-    now = datetime.now(timezone.utc)
 
     await versions_col.insert_one({
         "layoutId": layout_oid,
@@ -58,27 +133,107 @@ async def snapshot_previous(layout_oid: ObjectId, innerHTML: str, reason: str):
         "createdAt": now
     })
 
-    # delete snapshots beyond the newest 4
-    cursor = versions_col.find({"layoutId": layout_oid}, {"_id": 1}).sort("createdAt", -1).skip(4)
-    old_ids = [doc["_id"] async for doc in cursor]
-    if old_ids:
-        await versions_col.delete_many({"_id": {"$in": old_ids}})
+    # delete snapshots beyond the newest 4: find the 5th newest, drop it and everything older.
+    # createdAt is only millisecond-precise, so _id breaks ties to keep the cut exact.
+    pivot = await versions_col.find(
+        {"layoutId": layout_oid}, {"_id": 1, "createdAt": 1}
+    ).sort([("createdAt", -1), ("_id", -1)]).skip(4).limit(1).to_list(1)
+    if pivot:
+        pivot_at, pivot_id = pivot[0]["createdAt"], pivot[0]["_id"]
+        await versions_col.delete_many({
+            "layoutId": layout_oid,
+            "$or": [
+                {"createdAt": {"$lt": pivot_at}},
+                {"createdAt": pivot_at, "_id": {"$lte": pivot_id}},
+            ]
+        })
 
 
 @app.on_event("startup")
 async def startup():
-    await versions_col.create_index([("layoutId", 1), ("createdAt", -1)])
+    # trailing _id lets the prune scan in snapshot_previous be served from the index alone
+    await versions_col.create_index([("layoutId", 1), ("createdAt", -1), ("_id", -1)])
+    # drop indexes the one above supersedes (older builds created them); missing ones are fine
+    for stale in ("layoutId_1_createdAt_-1", "layoutId_1_createdAt_-1__id_1"):
+        try:
+            await versions_col.drop_index(stale)
+        except OperationFailure:
+            pass
+    # backstop for snapshot_previous's prune: Mongo expires snapshots older than 30 days on its own
+    await versions_col.create_index("createdAt", expireAfterSeconds=60 * 60 * 24 * 30)
 
 
 # ---------------- Models ----------------
 Theme = Literal["Indigo", "Emerald", "Rose", "Cyan", "Amber", "Violet"]
 
 
+# theme object Gemini returns alongside its changes (lowercase, unlike the stored layout theme)
+PrimaryColor = Literal["indigo", "emerald", "rose", "amber", "cyan", "violet"]
+Spacing = Literal["compact", "comfortable"]
+Mode = Literal["light", "dark"]
+
+
+class ThemeObj(BaseModel):
+    primaryColor: PrimaryColor
+    spacing: Spacing
+    mode: Mode
+
+
+# action objects in Gemini's "changes" array; extra keys are passed through to the frontend
+class _ActionBase(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+
+class MoveAction(_ActionBase):
+    type: Literal["move"]
+    component: str
+    position: Union[int, str]
+
+
+class RemoveAction(_ActionBase):
+    type: Literal["remove"]
+    component: str
+
+
+class AddAction(_ActionBase):
+    # not described in the prompt; accepted as-is like before
+    type: Literal["add"]
+
+
+class ToggleVisibilityAction(_ActionBase):
+    type: Literal["toggle_visibility"]
+    component: str
+    visible: bool
+
+
+class UpdatePropsAction(_ActionBase):
+    type: Literal["update_props"]
+    component: str
+    section: str
+    props: dict
+
+
+class UpdateThemeAction(_ActionBase):
+    type: Literal["update_theme"]
+    theme: ThemeObj
+
+
+Action = Annotated[
+    Union[MoveAction, RemoveAction, AddAction, ToggleVisibilityAction, UpdatePropsAction, UpdateThemeAction],
+    Field(discriminator="type"),
+]
+_CHANGES_ADAPTER = TypeAdapter(List[Action])
+
+
 class ChatRequest(BaseModel):
     prompt: str = Field(..., min_length=1, max_length=50_000)
     innerHTML: str = Field(..., min_length=1, max_length=1_000_000)
 
 
+class BatchChatRequest(BaseModel):
+    items: List[ChatRequest] = Field(..., min_length=1, max_length=20)
+
+
 class CreateLayoutRequest(BaseModel):
     innerHTML: str = Field(..., min_length=1, max_length=1_000_000)
     theme: Optional[Theme] = None
@@ -109,23 +264,37 @@ class VersionsOut(BaseModel):
 
 
 # ---------------- Routes ----------------
-@app.get("/health")
-async def health_check():
+# last ping result as (monotonic timestamp, ok); health probes within 1s reuse it,
+# and probes arriving while a ping is in flight await that same ping
+_mongo_health: tuple[float, bool] = (float("-inf"), False)
+_mongo_ping_task: Optional[asyncio.Task] = None
+
+
+async def _ping_mongo() -> bool:
+    global _mongo_health
     try:
-        await db.command("ping")
+        await asyncio.wait_for(db.command("ping"), timeout=0.5)
         mongo_ok = True
     except Exception:
         mongo_ok = False
-    return {"ok": True, "mongo": mongo_ok}
+    _mongo_health = (time.monotonic(), mongo_ok)
+    return mongo_ok
 
 
-@app.post("/chat")
-async def chat_endpoint(req: ChatRequest):
-    if not GEMINI_API_KEY:
-        raise HTTPException(status_code=500, detail="Gemini API key not found")
+@app.get("/health")
+async def health_check():
+    global _mongo_ping_task
+    checked_at, mongo_ok = _mongo_health
+    if time.monotonic() - checked_at >= 1.0:
+        if _mongo_ping_task is None or _mongo_ping_task.done():
+            _mongo_ping_task = asyncio.create_task(_ping_mongo())
+        # shield: a disconnecting probe mustn't cancel the ping other probes are waiting on
+        mongo_ok = await asyncio.shield(_mongo_ping_task)
+    return {"ok": True, "mongo": mongo_ok}
 
-    try:
-        gemini_prompt = f"""
+
+# static parts of the Gemini prompt; only innerHTML and the user prompt vary per request
+_PROMPT_PREFIX = """
 You are an assistant helping edit a website layout.
 
 You will output changes as an array of actions. Do NOT output HTML.
@@ -133,21 +302,21 @@ You will output changes as an array of actions. Do NOT output HTML.
 The frontend supports ONLY these action objects in the "changes" array:
 
 1) Move a component:
-{{ "type": "move", "component": "hero|featured-products|testimonials|newsletter|footer", "position": "top|bottom|<number>" }}
+{ "type": "move", "component": "hero|featured-products|testimonials|newsletter|footer", "position": "top|bottom|<number>" }
 
 2) Remove a component:
-{{ "type": "remove", "component": "hero|featured-products|testimonials|newsletter|footer" }}
+{ "type": "remove", "component": "hero|featured-products|testimonials|newsletter|footer" }
 
 3) Toggle visibility:
-{{ "type": "toggle_visibility", "component": "hero|featured-products|testimonials|newsletter|footer", "visible": true|false }}
+{ "type": "toggle_visibility", "component": "hero|featured-products|testimonials|newsletter|footer", "visible": true|false }
 
 4) Update text content in a section:
-{{ "type": "update_props", "component": "hero|featured-products|testimonials|newsletter|footer",
-  "section": "<one of the provided section keys>", "props": {{ "<key>": "<string value>" }} }}
+{ "type": "update_props", "component": "hero|featured-products|testimonials|newsletter|footer",
+  "section": "<one of the provided section keys>", "props": { "<key>": "<string value>" } }
 
 5) Update theme:
-{{ "type": "update_theme", "theme": {{ "primaryColor": "indigo|emerald|rose|amber|cyan|violet",
-  "spacing": "compact|comfortable", "mode": "light|dark" }} }}
+{ "type": "update_theme", "theme": { "primaryColor": "indigo|emerald|rose|amber|cyan|violet",
+  "spacing": "compact|comfortable", "mode": "light|dark" } }
 
 IMPORTANT RULES:
 - Return ONLY valid JSON, no markdown, no extra text.
@@ -157,39 +326,52 @@ IMPORTANT RULES:
 - Keep the number of actions small (max 8).
 
 Context (current HTML for reference only, do NOT output HTML):
-{req.innerHTML}
-
-User request:
-{req.prompt}
+"""
+_PROMPT_MIDDLE = "\n\nUser request:\n"
+_PROMPT_SUFFIX = """
 
 Return ONLY this JSON format:
-{{
+{
   "reason": "one short paragraph",
   "changes": [ /* array of action objects */ ],
-  "theme": {{
+  "theme": {
     "primaryColor": "indigo|emerald|rose|amber|cyan|violet",
     "spacing": "compact|comfortable",
     "mode": "light|dark"
-  }}
-}}
+  }
+}
 """
 
-        client = google.genai.Client(api_key=GEMINI_API_KEY)
-        res = client.models.generate_content(
-            model="gemini-3-pro-preview",
-            contents=gemini_prompt
-        )
+
+async def run_chat(req: ChatRequest) -> dict:
+    """Ask Gemini for layout changes and validate its JSON reply."""
+    # length-prefix each field so no (prompt, innerHTML) pair can collide with another
+    h = blake2b(digest_size=16)
+    for field in (req.prompt, req.innerHTML):
+        raw = field.encode()
+        h.update(len(raw).to_bytes(8, "big"))
+        h.update(raw)
+    cache_key = h.hexdigest()
+    cached = _chat_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    try:
+        gemini_prompt = "".join((_PROMPT_PREFIX, req.innerHTML, _PROMPT_MIDDLE, req.prompt, _PROMPT_SUFFIX))
+
+        async with _GEMINI_SEM:
+            res = await _gemini_client.aio.models.generate_content(
+                model="gemini-3-pro-preview",
+                contents=gemini_prompt
+            )
 
         text = (res.text or "").strip()
 
         # Extract JSON object (Gemini sometimes adds extra text)
-        start = text.find("{")
-        end = text.rfind("}")
-        if start == -1 or end == -1 or end <= start:
+        data = parse_json_object(text)
+        if data is None:
             raise HTTPException(status_code=500, detail="Gemini did not return JSON")
 
-        data = json.loads(text[start:end+1])
-
         # Required fields
         if "reason" not in data or "changes" not in data:
             raise HTTPException(status_code=500, detail="Missing required fields in Gemini response")
@@ -200,13 +382,14 @@ Return ONLY this JSON format:
         if not isinstance(data["changes"], list):
             raise HTTPException(status_code=500, detail="Field 'changes' must be an array")
 
-        # Light validation: action type must be one of these
-        allowed_types = {"move", "remove", "add", "update_props", "toggle_visibility", "update_theme"}
-        for action in data["changes"]:
-            if not isinstance(action, dict):
-                raise HTTPException(status_code=500, detail="Each change must be an object")
-            if action.get("type") not in allowed_types:
-                raise HTTPException(status_code=500, detail=f"Invalid change type: {action.get('type')}")
+        # Validate every action against its schema in one pass (dispatches on "type").
+        # Strict, so what we return is exactly what was checked (no "false" -> False coercion).
+        try:
+            _CHANGES_ADAPTER.validate_python(data["changes"], strict=True)
+        except ValidationError as e:
+            err = e.errors()[0]
+            loc = ".".join(str(part) for part in err["loc"])
+            raise HTTPException(status_code=500, detail=f"Invalid change at {loc}: {err['msg']}")
 
         # Theme is optional in your TS type, but you usually want it present.
         # We'll allow missing theme, but if present validate it loosely.
@@ -214,16 +397,16 @@ Return ONLY this JSON format:
             theme = data["theme"]
             if not isinstance(theme, dict):
                 raise HTTPException(status_code=500, detail="Field 'theme' must be an object")
-            if theme.get("primaryColor") not in ["indigo", "emerald", "rose", "amber", "cyan", "violet"]:
-                raise HTTPException(status_code=400, detail="Invalid theme.primaryColor")
-            if theme.get("spacing") not in ["compact", "comfortable"]:
-                raise HTTPException(status_code=400, detail="Invalid theme.spacing")
-            if theme.get("mode") not in ["light", "dark"]:
-                raise HTTPException(status_code=400, detail="Invalid theme.mode")
+            try:
+                ThemeObj.model_validate(theme)
+            except ValidationError as e:
+                field = e.errors()[0]["loc"][0]
+                raise HTTPException(status_code=400, detail=f"Invalid theme.{field}")
 
+        _chat_cache[cache_key] = data
         return data
 
-    except json.JSONDecodeError:
+    except json.JSONDecodeError:  # also covers orjson.JSONDecodeError (a subclass)
         raise HTTPException(status_code=500, detail="Gemini returned invalid JSON")
     except HTTPException:
         raise
@@ -231,6 +414,27 @@ Return ONLY this JSON format:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.post("/chat")
+async def chat_endpoint(req: ChatRequest):
+    return await run_chat(req)
+
+
+@app.post("/chat/batch")
+async def chat_batch_endpoint(req: BatchChatRequest):
+    results = await asyncio.gather(*[run_chat(r) for r in req.items], return_exceptions=True)
+
+    # one failed prompt shouldn't fail the whole batch; keep results index-aligned
+    responses = []
+    for r in results:
+        if isinstance(r, HTTPException):
+            responses.append({"error": r.detail})
+        elif isinstance(r, Exception):
+            responses.append({"error": str(r)})
+        else:
+            responses.append(r)
+    return {"responses": responses}
+
+
 # ----------- Layout persistence (NO AUTH, by layoutId) -----------
 
 @app.post("/layouts", response_model=LayoutOut)
@@ -246,7 +450,7 @@ async def create_layout(req: CreateLayoutRequest):
     layout_id = res.inserted_id
 
     # initial snapshot (so you can restore initial)
-    await snapshot_previous(layout_id, req.innerHTML, "initial_create")
+    await snapshot_previous(layout_id, req.innerHTML, "initial_create", now)
 
     return LayoutOut(
         layoutId=str(layout_id),
@@ -274,19 +478,28 @@ async def get_layout(layoutId: str):
 @app.patch("/layouts/{layoutId}", response_model=LayoutOut)
 async def update_layout(layoutId: str, req: UpdateLayoutRequest):
     oid = to_oid(layoutId)
-    current = await layouts_col.find_one({"_id": oid})
-    if not current:
-        raise HTTPException(status_code=404, detail="Layout not found")
-
-    # snapshot previous for undo
-    await snapshot_previous(oid, current["innerHTML"], req.reason or "manual_update")
-
     now = datetime.now(timezone.utc)
     update_doc = {"innerHTML": req.innerHTML, "updatedAt": now}
     if req.theme is not None:
         update_doc["theme"] = req.theme
 
-    await layouts_col.update_one({"_id": oid}, {"$set": update_doc})
+    # fetch the previous state and apply the update in one round-trip
+    current = await layouts_col.find_one_and_update(
+        {"_id": oid},
+        {"$set": update_doc},
+        projection={"innerHTML": 1, "theme": 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if not current:
+        raise HTTPException(status_code=404, detail="Layout not found")
+
+    # snapshot previous for undo before responding, so /versions and /restore see it.
+    # The update is already committed, so a failed snapshot only costs this undo point:
+    # log it and still report the write as saved.
+    try:
+        await snapshot_previous(oid, current["innerHTML"], req.reason or "manual_update", now)
+    except Exception:
+        logger.exception("Failed to snapshot layout %s before update", layoutId)
 
     return LayoutOut(
         layoutId=layoutId,
@@ -303,19 +516,22 @@ async def get_versions(layoutId: str, limit: int = 4):
 
     oid = to_oid(layoutId)
 
-    exists = await layouts_col.find_one({"_id": oid}, {"_id": 1})
+    # existence check and versions query go out together instead of back to back
+    exists, versions = await asyncio.gather(
+        layouts_col.find_one({"_id": oid}, {"_id": 1}),
+        versions_col.find({"layoutId": oid}, {"innerHTML": 0, "layoutId": 0}).sort("createdAt", -1).limit(limit).to_list(limit),
+    )
     if not exists:
         raise HTTPException(status_code=404, detail="Layout not found")
 
-    cursor = versions_col.find({"layoutId": oid}, {"innerHTML": 0}).sort("createdAt", -1).limit(limit)
-
-    out = []
-    async for v in cursor:
-        out.append(VersionOut(
+    out = [
+        VersionOut(
             versionId=str(v["_id"]),
             createdAt=iso(v["createdAt"]),
             reason=v.get("reason", "")
-        ))
+        )
+        for v in versions
+    ]
 
     return VersionsOut(layoutId=layoutId, versions=out)
 
@@ -325,18 +541,20 @@ async def restore_version(layoutId: str, versionId: str):
     layout_oid = to_oid(layoutId)
     version_oid = to_oid(versionId)
 
-    current = await layouts_col.find_one({"_id": layout_oid})
+    current, version = await asyncio.gather(
+        layouts_col.find_one({"_id": layout_oid}),
+        versions_col.find_one({"_id": version_oid, "layoutId": layout_oid}),
+    )
     if not current:
         raise HTTPException(status_code=404, detail="Layout not found")
-
-    version = await versions_col.find_one({"_id": version_oid, "layoutId": layout_oid})
     if not version:
         raise HTTPException(status_code=404, detail="Version not found for this layout")
 
+    now = datetime.now(timezone.utc)
+
     # snapshot current before restoring (so restore itself is undoable)
-    await snapshot_previous(layout_oid, current["innerHTML"], "restore_snapshot")
+    await snapshot_previous(layout_oid, current["innerHTML"], "restore_snapshot", now)
 
-    now = datetime.now(timezone.utc)
     await layouts_col.update_one(
         {"_id": layout_oid},
         {"$set": {"innerHTML": version["innerHTML"], "updatedAt": now}}